@@ -1,13 +1,23 @@
+import csv
 import io
 import base64
 import hashlib
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Optional
 
+import numpy as np
 import pandas as pd
 import requests
 import streamlit as st
-from sklearn.metrics import f1_score
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import pyarrow  # noqa: F401
+    _CSV_ENGINE = "pyarrow"  # parser multihilo con buffers columnares
+except ImportError:
+    _CSV_ENGINE = "c"
 
 # ------------------------------ PAGE SETUP ------------------------------
 st.set_page_config(page_title="Evaluator F1", page_icon="📊", layout="centered")
@@ -16,15 +26,43 @@ st.caption("Sube un CSV con columnas: id, prediction. El ranking es público y s
 
 MODE_OPTIONS = ["Presencial", "Online"]
 
+# Esquemas de columnas, fijados a nivel de módulo (el script se re-ejecuta entero
+# en cada interacción; no hay que reconstruir estos literales por rerun)
+_GT_COLS = ("id", "target")
+_USER_COLS = ("id", "prediction")
+
 # ------------------------------ CONFIG ------------------------------
+# Sesión compartida: reutiliza la conexión TCP/TLS entre llamadas a la API
+# (lectura+escritura del mismo envío) y reintenta fallos transitorios
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(429, 500, 502, 503, 504),
+        ),
+    ),
+)
+
 @st.cache_data(show_spinner=False)
 def _gh_headers() -> dict:
     return {
         "Authorization": f"Bearer {st.secrets['GH_TOKEN']}",
         "Accept": "application/vnd.github+json",
+        "Accept-Encoding": "gzip",
         "X-GitHub-Api-Version": "2022-11-28",
     }
 
+@st.cache_data(show_spinner=False)
+def _gh_headers_raw() -> dict:
+    """Variante para GETs de contenido: el cuerpo llega crudo, sin el sobre JSON
+    con base64 (un 33% menos de bytes por el cable y sin paso de decode)."""
+    return {**_gh_headers(), "Accept": "application/vnd.github.raw"}
+
 @st.cache_data(show_spinner=False)
 def _gh_repo_paths() -> Tuple[str, str, str, str]:
     """Convenience: (owner_repo, gt_path, log_path, ref)"""
@@ -36,15 +74,55 @@ def _gh_repo_paths() -> Tuple[str, str, str, str]:
 
 # ------------------------------ GROUND TRUTH LOADER ------------------------------
 @st.cache_data(show_spinner=False, ttl=300)
-def load_gt_from_github() -> pd.DataFrame:
-    """Carga el GT desde el repo privado. Soporta ficheros >1MB usando download_url.
-    Reintenta de forma ligera ante fallos transitorios.
+def _gt_blob_sha() -> str:
+    """Consulta solo el sha del blob del GT (metadata ligera, cacheada por TTL)."""
+    owner_repo, gt_path, _, ref = _gh_repo_paths()
+    url = f"https://api.github.com/repos/{owner_repo}/contents/{gt_path}?ref={ref}"
+    r = _SESSION.get(url, headers=_gh_headers(), timeout=30)
+    r.raise_for_status()
+    meta = r.json()
+    if isinstance(meta, list):
+        raise RuntimeError("GT_PATH apunta a un directorio; debe ser un archivo CSV.")
+    return meta["sha"]
+
+def _parse_gt_csv(source) -> pd.DataFrame:
+    """Parsea el CSV del GT desde bytes o un file-like, con tipos compactos
+    (string/int8) para reducir memoria frente a object/int64."""
+    # usecols: el parser salta por completo cualquier columna extra del CSV
+    # (y falla de entrada si faltan las obligatorias)
+    df = pd.read_csv(source, usecols=list(_GT_COLS),
+                     dtype={"id": "string", "target": "int8"}, engine=_CSV_ENGINE)
+
+    # Garantiza unicidad de IDs en el GT (una sola pasada: la máscara sirve
+    # para contar y para filtrar)
+    dup_mask = df["id"].duplicated()
+    dup_count = int(dup_mask.sum())
+    if dup_count:
+        st.warning(f"Se encontraron {dup_count} IDs duplicados en el ground truth; se conservará la primera ocurrencia.")
+        df = df.loc[~dup_mask]
+
+    # Valida el conjunto de etiquetas una sola vez aquí (cacheado por sha): las
+    # métricas en forma cerrada asumen target binario {0,1}, así que ningún
+    # envío tiene que volver a descubrir/verificar etiquetas del GT
+    targets = df["target"].to_numpy(dtype=np.int8)
+    if targets.size and (int(targets.min()) < 0 or int(targets.max()) > 1):
+        raise ValueError("El ground truth debe tener target binario 0/1")
+
+    # id como índice ordenado: el orden se paga una vez aquí (cacheado por sha)
+    # y la alineación por búsqueda binaria lo reutiliza tal cual
+    return df.set_index("id").sort_index()
+
+@st.cache_data(show_spinner=False)
+def _load_gt(sha: str) -> pd.DataFrame:
+    """Descarga y parsea el GT. Cacheado por sha: solo corre cuando el blob cambia.
+    Para ficheros >1MB la descarga se hace en streaming directamente al parser,
+    sin buffer intermedio con el fichero completo.
     """
     owner_repo, gt_path, _, ref = _gh_repo_paths()
 
     url = f"https://api.github.com/repos/{owner_repo}/contents/{gt_path}?ref={ref}"
     # Primero pedimos el JSON de metadata para evitar el límite de 1MB del 'Accept: raw'
-    r = requests.get(url, headers=_gh_headers(), timeout=30)
+    r = _SESSION.get(url, headers=_gh_headers(), timeout=30)
     r.raise_for_status()
     meta = r.json()
 
@@ -57,33 +135,146 @@ def load_gt_from_github() -> pd.DataFrame:
     download_url: Optional[str] = meta.get("download_url")
 
     if content_b64 and encoding == "base64":
-        raw_bytes = base64.b64decode(content_b64)
-    elif download_url:
-        r2 = requests.get(download_url, headers={"Authorization": _gh_headers()["Authorization"]}, timeout=60)
-        r2.raise_for_status()
-        raw_bytes = r2.content
-    else:
-        # Fallback a solicitar el raw directamente (no debería ser necesario)
-        r3 = requests.get(url, headers={**_gh_headers(), "Accept": "application/vnd.github.raw"}, timeout=60)
+        return _parse_gt_csv(io.BytesIO(base64.b64decode(content_b64)))
+    if download_url:
+        with _SESSION.get(download_url, headers={"Authorization": _gh_headers()["Authorization"]},
+                          stream=True, timeout=60) as r2:
+            r2.raise_for_status()
+            r2.raw.decode_content = True
+            return _parse_gt_csv(r2.raw)
+    # Fallback a solicitar el raw directamente (no debería ser necesario)
+    with _SESSION.get(url, headers={**_gh_headers(), "Accept": "application/vnd.github.raw"},
+                      stream=True, timeout=60) as r3:
         r3.raise_for_status()
-        raw_bytes = r3.content
+        r3.raw.decode_content = True
+        return _parse_gt_csv(r3.raw)
+
+def load_gt_from_github() -> pd.DataFrame:
+    """Carga el GT desde el repo privado, cacheado por sha del blob: la descarga
+    y el parseo solo se repiten cuando el fichero realmente cambia.
+    """
+    return _load_gt(_gt_blob_sha())
 
-    df = pd.read_csv(io.BytesIO(raw_bytes))
-    # Validación mínima
-    expected = {"id", "target"}
-    if not expected.issubset(df.columns):
-        raise ValueError("El ground truth no tiene columnas: id, target")
+# ------------------------------ EVALUACIÓN ------------------------------
 
-    # Garantiza unicidad de IDs en el GT
-    if df["id"].duplicated().any():
-        dup_count = int(df["id"].duplicated().sum())
-        st.warning(f"Se encontraron {dup_count} IDs duplicados en el ground truth; se conservará la primera ocurrencia.")
-        df = df.drop_duplicates(subset=["id"], keep="first")
+@st.cache_data(show_spinner=False)
+def parse_user_csv(sha256: str, _file) -> pd.DataFrame:
+    """Parsea el CSV subido leyendo directamente del fichero, sin copia previa a
+    bytes+BytesIO. Cacheado por hash del contenido (_file no entra en la clave):
+    re-clicks del botón o cambios de modalidad reutilizan el DataFrame."""
+    _file.seek(0)
+    return pd.read_csv(_file, usecols=list(_USER_COLS),
+                       dtype={"id": "string", "prediction": "float32"}, engine=_CSV_ENGINE)
+
+
+def _gt_sorted_arrays(gt_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """(ids ordenados, targets int8 alineados): el GT ya llega con índice id
+    ordenado desde el loader, así que aquí solo se materializan los arrays una
+    vez por versión del GT (sha del blob, la misma clave que versiona _load_gt);
+    la alineación de cada envío es una búsqueda binaria sobre arrays planos,
+    sin hash tables ni merge por evaluación."""
+    sha = _gt_blob_sha()
+    cached = st.session_state.get("gt_sorted_arrays")
+    if cached is None or cached[0] != sha:
+        cached = (sha, (
+            gt_df.index.to_numpy(),
+            gt_df["target"].to_numpy(dtype=np.int8),
+        ))
+        st.session_state["gt_sorted_arrays"] = cached
+    return cached[1]
+
+
+def _binarize_if_needed(arr: np.ndarray, threshold: float = 0.5) -> np.ndarray:
+    """Convierte predicciones a etiquetas int8 0/1 en una sola pasada NumPy:
+    si la columna ya es {0,1} se castea directamente; si son probabilidades en
+    [0, 1] se umbraliza en `threshold`; cualquier otro rango es un error."""
+    mn, mx = float(arr.min()), float(arr.max())
+    if mn < 0.0 or mx > 1.0:
+        raise ValueError("prediction debe ser 0/1 o una probabilidad en [0, 1]")
+    if np.all((arr == 0.0) | (arr == 1.0)):
+        return arr.astype(np.int8)
+    return (arr >= threshold).astype(np.int8)
+
+
+try:
+    import numba
+
+    @numba.njit(parallel=True, cache=True, boundscheck=False)
+    def _confusion2x2(y_true, y_pred):
+        # Conteo 2x2 fusionado y paralelo sobre int8: sin el temporal int32
+        # que asigna la variante bincount
+        tn = fp = fn = tp = 0
+        for i in numba.prange(y_true.shape[0]):
+            t = y_true[i]
+            p = y_pred[i]
+            if t == 0 and p == 0:
+                tn += 1
+            elif t == 0:
+                fp += 1
+            elif p == 0:
+                fn += 1
+            else:
+                tp += 1
+        return tn, fp, fn, tp
+
+    # Warm-up en el arranque: la compilación JIT (o la carga desde la caché de
+    # numba) se paga al bootear la app, no en el primer envío de un alumno
+    _confusion2x2(np.zeros(1, dtype=np.int8), np.zeros(1, dtype=np.int8))
+except ImportError:
+    def _confusion2x2(y_true: np.ndarray, y_pred: np.ndarray):
+        """Fallback NumPy: un único bincount sobre el índice 2*t + p."""
+        idx = (y_true.astype(np.int32) << 1) | y_pred.astype(np.int32)
+        tn, fp, fn, tp = np.bincount(idx, minlength=4)
+        return int(tn), int(fp), int(fn), int(tp)
+
+
+def _binary_metrics(y_true: np.ndarray, y_pred: np.ndarray) -> dict:
+    """Matriz de confusión 2x2 y métricas derivadas para etiquetas binarias 0/1,
+    todo a partir de una única pasada de conteo sobre arrays int8:
+    precision/recall/F1 y soporte por clase, agregados macro/weighted y
+    accuracy, sin las pasadas extra ni el descubrimiento de etiquetas de
+    sklearn (0 ante denominador 0, como zero_division=0).
+    """
+    tn, fp, fn, tp = (int(v) for v in _confusion2x2(y_true, y_pred))
+
+    def _prf(tp_, fp_, fn_):
+        p = tp_ / (tp_ + fp_) if (tp_ + fp_) else 0.0
+        r = tp_ / (tp_ + fn_) if (tp_ + fn_) else 0.0
+        f = 2 * p * r / (p + r) if (p + r) else 0.0
+        return p, r, f
 
-    return df[["id", "target"]]
+    p0, r0, f0 = _prf(tn, fn, fp)
+    p1, r1, f1 = _prf(tp, fp, fn)
+    s0, s1 = tn + fp, fn + tp
+    total = s0 + s1
+
+    return {
+        "confusion_matrix": [[tn, fp], [fn, tp]],
+        "per_class": {
+            0: {"precision": p0, "recall": r0, "f1": f0, "support": s0},
+            1: {"precision": p1, "recall": r1, "f1": f1, "support": s1},
+        },
+        "accuracy": (tn + tp) / total if total else 0.0,
+        "f1_macro": (f0 + f1) / 2,
+        "f1_weighted": (s0 * f0 + s1 * f1) / total if total else 0.0,
+    }
 
 # ------------------------------ LOG HELPERS ------------------------------
 
+_LOG_COLUMNS = ["timestamp_utc", "user_id", "file_sha256", "n_ids", "f1_weighted", "mode"]
+
+def _rows_to_csv_bytes(rows: list) -> bytes:
+    """Serializa filas de log a CSV directamente, sin DataFrame intermedio
+    (la escritura cuesta O(bytes de las filas), sin round-trip por pandas).
+    Escribe sobre un buffer de bytes: no se materializa el str completo."""
+    buf = io.BytesIO()
+    text = io.TextIOWrapper(buf, encoding="utf-8", newline="")
+    writer = csv.DictWriter(text, fieldnames=_LOG_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+    text.flush()
+    return buf.getvalue()
+
 def _put_contents(owner_repo: str, log_path: str, content_bytes: bytes, sha: Optional[str]) -> None:
     url = f"https://api.github.com/repos/{owner_repo}/contents/{log_path}"
     body = {
@@ -93,122 +284,160 @@ def _put_contents(owner_repo: str, log_path: str, content_bytes: bytes, sha: Opt
     }
     if sha:
         body["sha"] = sha
-    r = requests.put(url, headers=_gh_headers(), json=body, timeout=60)
-    if r.status_code == 409:
+    r = _SESSION.put(url, headers=_gh_headers(), json=body, timeout=60)
+    if r.status_code in (409, 422):
+        # 409: sha obsoleto; 422: el path ya existe y no se pasó sha
         raise RuntimeError("conflict")
     r.raise_for_status()
 
-def _read_log_from_github_nocache() -> Tuple[Optional[pd.DataFrame], Optional[str]]:
-    owner_repo, _, log_path, ref = _gh_repo_paths()
-    url = f"https://api.github.com/repos/{owner_repo}/contents/{log_path}?ref={ref}"
-    r = requests.get(url, headers=_gh_headers(), timeout=30)
+def _list_log_shards(owner_repo: str, log_dir: str, ref: str, headers: dict,
+                     cached: Optional[Tuple[Optional[str], list]] = None) -> Tuple[Optional[str], list]:
+    """Lista (path, sha) de los shards de envío bajo el directorio de logs.
+    Devuelve (etag, shards); con `cached` (etag, shards previos) manda
+    If-None-Match y un 304 reutiliza el listado sin transferir el árbol."""
+    url = f"https://api.github.com/repos/{owner_repo}/git/trees/{ref}?recursive=1"
+    if cached and cached[0]:
+        headers = {**headers, "If-None-Match": cached[0]}
+    r = _SESSION.get(url, headers=headers, timeout=30)
+    if cached and r.status_code == 304:
+        return cached
     if r.status_code == 404:
-        return None, None
+        return None, []
+    r.raise_for_status()
+    prefix = log_dir + "/"
+    shards = [
+        (t["path"], t["sha"])
+        for t in r.json().get("tree", [])
+        if t.get("type") == "blob" and t["path"].startswith(prefix)
+    ]
+    return r.headers.get("ETag"), shards
+
+@st.cache_data(show_spinner=False)
+def _fetch_shard_df(owner_repo: str, path: str, sha: str) -> pd.DataFrame:
+    """Descarga y parsea un shard. Cacheado por sha: los shards son inmutables,
+    así que cada lectura del historial solo descarga los envíos nuevos."""
+    url = f"https://api.github.com/repos/{owner_repo}/git/blobs/{sha}"
+    r = _SESSION.get(url, headers=_gh_headers_raw(), timeout=30)
     r.raise_for_status()
-    j = r.json()
-    content_b64 = j.get("content", "")
-    sha = j.get("sha")
-    data = base64.b64decode(content_b64) if content_b64 else b""
-    if not data:
-        return pd.DataFrame(columns=["timestamp_utc", "user_id", "file_sha256", "n_ids", "f1_weighted", "mode"]), sha
-    df = pd.read_csv(io.BytesIO(data))
+    return pd.read_csv(io.BytesIO(r.content))
+
+def _read_log_from_github_nocache() -> Optional[pd.DataFrame]:
+    """Lee el historial completo: el CSV monolítico heredado (si existe) más los
+    shards por envío bajo {LOG_PATH}.d/."""
+    owner_repo, _, log_path, ref = _gh_repo_paths()
+    headers = _gh_headers()
+    parts = []
+
+    # Validación condicional por ETag: si nada cambió, GitHub responde 304 sin
+    # cuerpo (y sin consumir cuota) y se reutiliza lo ya parseado en la sesión
+    legacy_cache = st.session_state.get("_log_legacy_cache")  # (etag, df|None)
+    shards_cache = st.session_state.get("_log_shards_cache")  # (etag, shards)
+    # el CSV heredado se pide con el media type raw: el cuerpo es el CSV tal
+    # cual, sin sobre JSON con base64 (ya no hace falta el sha para escribir)
+    legacy_headers = _gh_headers_raw()
+    if legacy_cache and legacy_cache[0]:
+        legacy_headers = {**legacy_headers, "If-None-Match": legacy_cache[0]}
+
+    # El GET del CSV heredado y el listado de shards son independientes:
+    # se lanzan en paralelo sobre la sesión con pool de conexiones
+    url = f"https://api.github.com/repos/{owner_repo}/contents/{log_path}?ref={ref}"
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        legacy_fut = pool.submit(_SESSION.get, url, headers=legacy_headers, timeout=30)
+        shards_fut = pool.submit(_list_log_shards, owner_repo, f"{log_path}.d", ref, headers, shards_cache)
+        r = legacy_fut.result()
+        shards_cache = shards_fut.result()
+
+    # CSV heredado (envíos anteriores al modelo de shards)
+    if legacy_cache and r.status_code == 304:
+        legacy_df = legacy_cache[1]
+    elif r.status_code == 404:
+        legacy_cache = (None, None)
+        legacy_df = None
+    else:
+        r.raise_for_status()
+        legacy_df = pd.read_csv(io.BytesIO(r.content)) if r.content else None
+        legacy_cache = (r.headers.get("ETag"), legacy_df)
+    st.session_state["_log_legacy_cache"] = legacy_cache
+    st.session_state["_log_shards_cache"] = shards_cache
+    if legacy_df is not None:
+        parts.append(legacy_df)
+
+    # Shards por envío
+    for path, sha in shards_cache[1]:
+        try:
+            parts.append(_fetch_shard_df(owner_repo, path, sha))
+        except Exception:
+            # un shard ilegible no debe tumbar el ranking completo
+            continue
+
+    if not parts:
+        return None
+    df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+    return _normalize_log_df(df)
+
+
+def _normalize_log_df(df: pd.DataFrame) -> pd.DataFrame:
+    """Normalizaciones de string una sola vez por frame: los filtros y el dedupe
+    por usuario pasan a comparar categorías (int8), no strings por fila. Se usa
+    tanto en la lectura del log como en el overlay de envíos recientes."""
     if "mode" not in df.columns:
         df["mode"] = ""
-    return df, sha
+    df["mode"] = df["mode"].astype(str).str.lower().astype("category")
+    df["_user_key"] = df["user_id"].astype(str).str.strip().str.lower().astype("category")
+    return df
 
 @st.cache_data(show_spinner=False, ttl=10)
-def read_log_from_github() -> Tuple[Optional[pd.DataFrame], Optional[str]]:
-    # pequeña caché para visualizar, pero las escrituras siempre usan la versión sin caché
+def read_log_from_github() -> Optional[pd.DataFrame]:
+    # pequeña caché para visualizar el ranking sin castigar la API
     return _read_log_from_github_nocache()
 
 
-def append_log_row_to_github(row: dict):
-    """Apendiza una fila al CSV de logs en GitHub (crea si no existe).
-       Reintenta contra conflictos SHA haciendo re-read *sin caché*.
+def append_log_rows_to_github(rows: list):
+    """Publica un envío como fichero nuevo bajo {LOG_PATH}.d/YYYYMM/ en lugar de
+       reescribir el log completo: el append cuesta O(fila), no O(historial), y
+       desaparecen los conflictos de SHA (y sus reintentos) entre envíos.
        Evita duplicados en la misma sesión con session_state.
     """
     owner_repo, _, log_path, _ = _gh_repo_paths()
 
-    key = f"logged_{row['file_sha256']}_{row['f1_weighted']}_{row['n_ids']}_{row.get('mode','')}"
+    key = "logged_" + "_".join(
+        f"{r['file_sha256']}_{r['f1_weighted']}_{r['n_ids']}_{r.get('mode','')}" for r in rows
+    )
     if st.session_state.get(key):
         return
 
-    # Intentos múltiples por concurrencia alta
-    last_exc: Optional[Exception] = None
-    for attempt in range(5):
-        try:
-            df, sha = _read_log_from_github_nocache()
-            if df is None:
-                new_df = pd.DataFrame([row])
-                csv_bytes = new_df.to_csv(index=False).encode()
-                _put_contents(owner_repo, log_path, csv_bytes, sha=None)
-            else:
-                # Alinear columnas esperadas
-                for col in ["timestamp_utc", "user_id", "file_sha256", "n_ids", "f1_weighted", "mode"]:
-                    if col not in df.columns:
-                        df[col] = ""
-                new_df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
-                csv_bytes = new_df.to_csv(index=False).encode()
-                _put_contents(owner_repo, log_path, csv_bytes, sha)
-            # Éxito: invalidar caché de lectura para que el ranking se actualice
-            try:
-                read_log_from_github.clear()
-            except Exception:
-                pass
-            st.session_state[key] = True
-            return
-        except RuntimeError as e:
-            last_exc = e
-            # conflicto -> reintenta
-            continue
-        except Exception as e:
-            last_exc = e
-            break
+    first = rows[0]
+    stamp = first["timestamp_utc"].replace("-", "").replace(":", "")  # p.ej. 20260901T101530Z
+    uid8 = hashlib.sha256(first["user_id"].encode()).hexdigest()[:8]
+    shard_path = f"{log_path}.d/{stamp[:6]}/{stamp}-{first['file_sha256'][:8]}-{uid8}.csv"
 
-    # Si llega aquí, falló tras varios intentos
-    if last_exc:
-        raise last_exc
-        return
-
-    # Alinea columnas esperadas
-    for col in ["timestamp_utc", "user_id", "file_sha256", "n_ids", "f1_weighted", "mode"]:
-        if col not in df.columns:
-            df[col] = ""
-
-    new_df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
-    csv_bytes = new_df.to_csv(index=False).encode()
+    csv_bytes = _rows_to_csv_bytes(rows)
     try:
-        _put_contents(owner_repo, log_path, csv_bytes, sha)
+        _put_contents(owner_repo, shard_path, csv_bytes, sha=None)
     except RuntimeError:
-        # Reintento
-        df2, sha2 = read_log_from_github()
-        if df2 is None:
-            df2 = pd.DataFrame(columns=new_df.columns)
-        new_df2 = pd.concat([df2, pd.DataFrame([row])], ignore_index=True)
-        csv_bytes2 = new_df2.to_csv(index=False).encode()
-        _put_contents(owner_repo, log_path, csv_bytes2, sha2)
-    finally:
-        st.session_state[key] = True
+        # El shard ya existe: mismo usuario, fichero y segundo -> ya publicado
+        pass
 
-# ------------------------------ HISTORY UI ------------------------------
+    # En lugar de invalidar la caché de lectura (que forzaría otro GET), las
+    # filas recién publicadas se superponen localmente al render del ranking
+    st.session_state.setdefault("_recent_rows", []).extend(rows)
+    st.session_state[key] = True
 
-def _render_leaderboard(df: pd.DataFrame, title: str):
-    st.markdown(f"### 🏆 {title}")
-    if df is None or df.empty:
-        st.info("Aún no hay resultados.")
-        return
+# ------------------------------ HISTORY UI ------------------------------
 
+def _best_by_user(df: pd.DataFrame) -> pd.DataFrame:
+    """Mejor F1 por usuario, ordenado para mostrar."""
     # Normaliza columnas obligatorias
-    for col in ["timestamp_utc", "user_id", "file_sha256", "n_ids", "f1_weighted", "mode"]:
+    df = df.copy()
+    for col in _LOG_COLUMNS:
         if col not in df.columns:
             df[col] = ""
+    if "_user_key" not in df.columns:
+        df["_user_key"] = df["user_id"].astype(str).str.strip().str.lower()
 
-    # Quedarse con el mejor F1 por usuario (por modo)
-    df = df.copy()
-    df["rank_key"] = df["user_id"].astype(str).str.strip().str.lower()
     best_by_user = (
-        df.sort_values(["rank_key", "f1_weighted", "timestamp_utc"], ascending=[True, False, False])
-          .drop_duplicates(subset=["rank_key"], keep="first")
+        df.sort_values(["_user_key", "f1_weighted", "timestamp_utc"], ascending=[True, False, False])
+          .drop_duplicates(subset=["_user_key"], keep="first")
     )
 
     leaderboard = (
@@ -223,44 +452,92 @@ def _render_leaderboard(df: pd.DataFrame, title: str):
         "n_ids": "#IDs",
         "timestamp_utc": "Último envío",
     }, inplace=True)
+    return leaderboard
 
+
+@st.cache_data(show_spinner=False)
+def _compute_leaderboards(history_df: pd.DataFrame) -> dict:
+    """Precalcula una vez por versión del log las vistas de ranking (global, por
+    modalidad y tabla completa): cambiar de pestaña no vuelve a ordenar nada."""
+    views = {
+        "global": _best_by_user(history_df),
+        "online": _best_by_user(history_df[history_df["mode"] == "online"]),
+        "presencial": _best_by_user(history_df[history_df["mode"] == "presencial"]),
+    }
+    # Tabla de envíos: solo se muestra el top-K, así que basta una selección
+    # parcial O(N) con argpartition y ordenar únicamente esas K filas
+    full = history_df.drop(columns=["_user_key"], errors="ignore")
+    k = min(50, len(full))
+    if len(full) > k:
+        f1 = pd.to_numeric(full["f1_weighted"], errors="coerce").fillna(-1.0).to_numpy()
+        full = full.iloc[np.argpartition(f1, len(f1) - k)[-k:]]
+    views["full"] = full.sort_values(["f1_weighted", "timestamp_utc"], ascending=[False, False])
+    return views
+
+
+def _render_leaderboard(leaderboard: pd.DataFrame, title: str):
+    st.markdown(f"### 🏆 {title}")
+    if leaderboard is None or leaderboard.empty:
+        st.info("Aún no hay resultados.")
+        return
     st.dataframe(leaderboard, use_container_width=True)
 
 
+@st.fragment(run_every="30s")
 def show_public_leaderboards():
+    # Fragmento: las interacciones (pestañas) y el auto-refresco del ranking no
+    # re-ejecutan el script completo (carga de GT, parseo del CSV, evaluación)
     try:
-        history_df, _ = read_log_from_github()
+        history_df = read_log_from_github()
     except Exception:
         history_df = None
 
+    # Superpone los envíos publicados en esta sesión que aún no aparecen en el
+    # log remoto (evita re-leer de GitHub justo después del PUT); cuando el log
+    # ya los refleja, se descartan del overlay
+    recent = st.session_state.get("_recent_rows")
+    if recent:
+        if history_df is not None and not history_df.empty:
+            seen = set(zip(history_df["timestamp_utc"].astype(str),
+                           history_df["file_sha256"].astype(str),
+                           history_df["mode"].astype(str)))
+            recent = [
+                row for row in recent
+                if (str(row["timestamp_utc"]), str(row["file_sha256"]), str(row["mode"])) not in seen
+            ]
+            st.session_state["_recent_rows"] = recent
+            if recent:
+                # Misma normalización que el log remoto: sin _user_key las filas
+                # del overlay contarían como un usuario aparte en el best-por-usuario
+                history_df = pd.concat(
+                    [history_df, _normalize_log_df(pd.DataFrame(recent))], ignore_index=True
+                )
+        else:
+            history_df = _normalize_log_df(pd.DataFrame(recent))
+
     st.subheader("Ranking público")
     if history_df is None or history_df.empty:
         st.info("Aún no hay envíos publicados.")
         return
 
-    # Normaliza columna 'mode'
-    if "mode" not in history_df.columns:
-        history_df["mode"] = ""
+    views = _compute_leaderboards(history_df)
 
-    # Tab por modalidad
+    # Tab por modalidad ('mode' ya viene normalizada a categoría en minúsculas)
     tabs = st.tabs(["Global", "Online", "Presencial", "Todos los envíos"])
 
     with tabs[0]:
-        _render_leaderboard(history_df, "Mejores resultados (Global)")
+        _render_leaderboard(views["global"], "Mejores resultados (Global)")
 
     with tabs[1]:
-        online = history_df[history_df["mode"].str.lower().eq("online")]
-        _render_leaderboard(online, "Mejores resultados · Online")
+        _render_leaderboard(views["online"], "Mejores resultados · Online")
 
     with tabs[2]:
-        pres = history_df[history_df["mode"].str.lower().eq("presencial")]
-        _render_leaderboard(pres, "Mejores resultados · Presencial")
+        _render_leaderboard(views["presencial"], "Mejores resultados · Presencial")
 
     with tabs[3]:
-        # Tabla completa, descendente por F1
-        full = history_df.copy()
-        full = full.sort_values(["f1_weighted", "timestamp_utc"], ascending=[False, False])
-        st.dataframe(full, use_container_width=True)
+        # Mejores envíos, descendente por F1
+        st.caption("Top 50 envíos por F1.")
+        st.dataframe(views["full"], use_container_width=True)
 
 # ------------------------------ MAIN UI ------------------------------
 
@@ -299,107 +576,122 @@ if run_eval:
 
 if run_eval and uploaded and valid_name and modes:
     try:
-        user_bytes = uploaded.read()
-        user_df = pd.read_csv(io.BytesIO(user_bytes))
+        # file_digest hace el mismo streaming que un bucle por bloques pero en
+        # un loop interno en C que suelta el GIL (y usa SHA-NI si está)
+        uploaded.seek(0)
+        file_sha256 = hashlib.file_digest(uploaded, "sha256").hexdigest()
+        user_df = parse_user_csv(file_sha256, uploaded)
     except Exception as e:
         st.error(f"CSV inválido: {e}")
         show_public_leaderboards()
         st.stop()
 
-    required_user_cols = {"id", "prediction"}
-    required_gt_cols = {"id", "target"}
+    # Re-click con el mismo fichero, nombre y modalidades ya publicados:
+    # no recalcular ni volver a tocar la API, solo mostrar el ranking
+    submit_key = "submitted_{}_{}_{}".format(
+        file_sha256, "-".join(sorted(m.lower() for m in modes)), user_id.strip().lower()
+    )
+    if st.session_state.get(submit_key):
+        st.info("Este envío ya fue evaluado y publicado; mostrando el ranking.")
+        show_public_leaderboards()
+        st.stop()
 
-    if not required_user_cols.issubset(user_df.columns):
+    if not set(_USER_COLS).issubset(user_df.columns):
         st.error("Tu CSV debe tener columnas: id, prediction")
         show_public_leaderboards()
         st.stop()
-    if not required_gt_cols.issubset(gt_df.columns):
-        st.error("El ground truth no tiene columnas: id, target")
+
+    # Fail-fast barato antes de tocar la alineación
+    if user_df.empty:
+        st.error("Tu CSV no contiene filas.")
         show_public_leaderboards()
         st.stop()
 
-    # Limpieza mínima
-    if user_df["id"].duplicated().any():
-        du = int(user_df["id"].duplicated().sum())
+    # Limpieza mínima (una sola pasada sobre id: la máscara cuenta y filtra)
+    dup_mask = user_df["id"].duplicated()
+    du = int(dup_mask.sum())
+    if du:
         st.warning(f"Tu CSV tiene {du} IDs duplicados; se conservará la primera ocurrencia.")
-        user_df = user_df.drop_duplicates(subset=["id"], keep="first")
-
-    gt_df["id"], user_df["id"] = gt_df["id"].astype(str), user_df["id"].astype(str)
-
-    # Eliminar filas con NA en prediction o target
-    before = len(user_df)
-    user_df = user_df.dropna(subset=["prediction"])
-    if len(user_df) < before:
-        st.info(f"Se eliminaron {before - len(user_df)} filas con prediction vacía.")
-
-    merged = pd.merge(
-        gt_df[list(required_gt_cols)],
-        user_df[list(required_user_cols)],
-        on="id",
-        how="inner",
-        validate="one_to_one",
-    )
-    if merged.empty:
+        user_df = user_df.loc[~dup_mask]
+
+    user_df["id"] = user_df["id"].astype(str)
+
+    # Alineación + limpieza fusionadas en una única máscara booleana: filas con
+    # prediction vacía y filas sin id en el GT se filtran en la misma pasada,
+    # sin el dropna intermedio (que copiaba el frame)
+    ids_sorted, targets_sorted = _gt_sorted_arrays(gt_df)
+    user_ids = user_df["id"].to_numpy()
+    pos = np.clip(np.searchsorted(ids_sorted, user_ids), 0, len(ids_sorted) - 1)
+    matched = ids_sorted[pos] == user_ids
+
+    # prediction ya viene tipada float32 desde el parser (la coerción numérica
+    # ocurre dentro del propio read_csv); no hay re-escaneo con pd.to_numeric
+    y_pred_f = user_df["prediction"].to_numpy(dtype=np.float32, copy=False)
+    pred_ok = ~np.isnan(y_pred_f)
+    mask = matched & pred_ok
+    n_eval = int(mask.sum())
+    if n_eval == 0:
         st.error("No hubo IDs coincidentes.")
         show_public_leaderboards()
         st.stop()
 
-    # Alinea tipos de etiquetas
-    try:
-        if pd.api.types.is_numeric_dtype(merged["target"]) and not pd.api.types.is_numeric_dtype(merged["prediction"]):
-            merged["prediction"] = pd.to_numeric(merged["prediction"], errors="coerce")
-        elif not pd.api.types.is_numeric_dtype(merged["target"]) and pd.api.types.is_numeric_dtype(merged["prediction"]):
-            merged["prediction"] = merged["prediction"].astype(str)
-    except Exception:
-        pass
+    n_pred_na = int((~pred_ok).sum())
+    if n_pred_na:
+        st.info(f"Se eliminaron {n_pred_na} filas con prediction vacía.")
+    n_sin_gt = int((pred_ok & ~matched).sum())
+    if n_sin_gt:
+        st.info(f"Se descartaron {n_sin_gt} filas sin id en el GT.")
 
-    na_before = len(merged)
-    merged = merged.dropna(subset=["target", "prediction"])
-    if len(merged) < na_before:
-        st.info(f"Se eliminaron {na_before - len(merged)} filas con etiquetas no válidas tras normalización.")
+    y_true = targets_sorted[pos[mask]]
+    try:
+        y_pred = _binarize_if_needed(y_pred_f[mask])
+    except ValueError as e:
+        st.error(str(e))
+        show_public_leaderboards()
+        st.stop()
 
-    # Cálculo del F1
+    # Cálculo de métricas
     try:
-        f1_w = f1_score(merged["target"], merged["prediction"], average="weighted")
+        metrics = _binary_metrics(y_true, y_pred)
+        f1_w = metrics["f1_weighted"]
         st.success(f"F1-score (weighted): {f1_w:.4f}")
         with st.expander("Detalles del conjunto evaluado"):
             st.write({
-                "n_ids_merged": int(len(merged)),
+                "n_ids_merged": n_eval,
                 "n_gt": int(len(gt_df)),
                 "n_user": int(len(user_df)),
-                "n_unique_targets": int(merged["target"].nunique()),
-                "n_unique_predictions": int(merged["prediction"].nunique()),
+                "accuracy": metrics["accuracy"],
+                "f1_macro": metrics["f1_macro"],
             })
+            st.write("Matriz de confusión (filas: target, columnas: prediction):")
+            st.dataframe(pd.DataFrame(metrics["confusion_matrix"], index=[0, 1], columns=[0, 1]))
+            st.write("Métricas por clase:")
+            st.dataframe(pd.DataFrame(metrics["per_class"]).T)
     except Exception as e:
         st.error(f"No se pudo calcular F1: {e}")
         show_public_leaderboards()
         st.stop()
 
     # ----- Guardar en historial -----
-    file_sha256 = hashlib.sha256(user_bytes).hexdigest()
     timestamp_utc = dt.datetime.now(dt.timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
 
-    ok_modes = []
-errors = []
-for m in modes:
-    row = {
-        "timestamp_utc": timestamp_utc,
-        "user_id": user_id.strip(),
-        "file_sha256": file_sha256,
-        "n_ids": int(len(merged)),
-        "f1_weighted": float(f1_w),
-        "mode": m.lower(),
-    }
+    rows = [
+        {
+            "timestamp_utc": timestamp_utc,
+            "user_id": user_id.strip(),
+            "file_sha256": file_sha256,
+            "n_ids": n_eval,
+            "f1_weighted": float(f1_w),
+            "mode": m.lower(),
+        }
+        for m in modes
+    ]
     try:
-        append_log_row_to_github(row)
-        ok_modes.append(m)
+        append_log_rows_to_github(rows)
+        st.success(f"Resultado(s) publicado(s) en: {', '.join(modes)}")
+        st.session_state[submit_key] = True
     except Exception as e:
-        errors.append(f"{m}: {e}")
-
-if ok_modes:
-    st.success(f"Resultado(s) publicado(s) en: {', '.join(ok_modes)}")
-if errors:
-    st.warning("No se pudo publicar en: " + ", ".join(errors))
+        st.warning(f"No se pudo publicar en {', '.join(modes)}: {e}")
 
 # ----- Mostrar historial (siempre disponible) -----
 show_public_leaderboards()